@@ -117,7 +117,7 @@ def render_tree_from_text(input_text: str):
                 value = node.name
             elif isinstance(node, VariableExpression):
                 color = svgwrite.rgb(150, 250, 150)
-            if node == node.get_root():
+            if node is expression:
                 color = svgwrite.rgb(250, 220, 200)
 
             if node.parent:
@@ -215,7 +215,7 @@ def render_features_from_text(input_text: str):
                 color = svgwrite.rgb(230, 230, 230)
             elif isinstance(n, VariableExpression):
                 color = svgwrite.rgb(150, 250, 150)
-            if n == n.get_root():
+            if n is expression:
                 color = svgwrite.rgb(250, 220, 200)
 
             box_with_char(tree, c, x=curr_x, y=BORDER_WIDTH, fill=color)
@@ -254,7 +254,7 @@ def render_types_from_text(input_text: str, visit_order: str):
                 color = svgwrite.rgb(230, 230, 230)
             elif isinstance(n, VariableExpression):
                 color = svgwrite.rgb(150, 250, 150)
-            if n == n.get_root():
+            if n is expression:
                 color = svgwrite.rgb(250, 220, 200)
 
             box_with_char(tree, c, x=curr_x, y=BORDER_WIDTH, fill=color)
@@ -1,19 +1,37 @@
 """Use Fractal Monte Carlo search in order to solve mathy problems without a
 trained neural network."""
+import os
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Union
 
 import numpy as np
 from fragile.core.env import DiscreteEnv
 from fragile.core.models import DiscreteModel
-from fragile.core.states import StatesEnv, StatesModel, StatesWalkers
+from fragile.core.states import StateDict, StatesEnv, StatesModel, StatesWalkers
 from fragile.core.swarm import Swarm
 from fragile.core.tree import HistoryTree
 from fragile.distributed.env import ParallelEnv
 from mathy_core import MathTypeKeysMax
 from mathy_envs import EnvRewards, MathyEnv, MathyEnvState
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 from wasabi import msg
 
+# Env states are stored as unicode code points padded to a fixed width. Problem
+# text is user input and may contain non-ASCII characters (e.g. "–" as a minus
+# sign), so use a dtype that holds any code point rather than a single byte.
+STATE_DTYPE = np.uint32
+STATE_PAD_SIZE = 2048
+# MathyEnvState.to_np pads with spaces
+STATE_PAD_VALUE = ord(" ")
+
+
+def available_cpu_count() -> int:
+    """Return the number of CPUs this process may run on, respecting affinity
+    masks (e.g. container CPU sets) where the platform reports them."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
 
 class SwarmConfig(BaseModel):
     use_mp: bool = True
@@ -22,13 +40,32 @@ class SwarmConfig(BaseModel):
     single_problem: bool = False
     verbose: bool = False
     n_walkers: int = 512
+    # fragile's default of 8 env worker processes, but never more than the CPUs
+    # this process can use (e.g. inside a container with a small CPU set)
+    n_workers: int = min(8, available_cpu_count())
     max_iters: int = 100
 
+    @validator("n_workers")
+    def n_workers_positive(cls, value: int) -> int:
+        if value < 1:
+            raise ValueError("n_workers must be at least 1")
+        return value
+
 
 def mathy_dist(x: np.ndarray, y: np.ndarray) -> np.ndarray:
     return np.linalg.norm(x - y, axis=1)
 
 
+def random_choice_prob_index(
+    random_state: np.random.RandomState, a: np.ndarray, axis: int = 1
+) -> np.ndarray:
+    """Select random actions with probabilities across a batch.
+
+    Source: https://stackoverflow.com/a/47722393/287335"""
+    r = np.expand_dims(random_state.rand(a.shape[1 - axis]), axis=axis)
+    return (a.cumsum(axis=axis) > r).argmax(axis=axis)
+
+
 class DiscreteMasked(DiscreteModel):
     def sample(
         self,
@@ -38,19 +75,12 @@ class DiscreteMasked(DiscreteModel):
         walkers_states: StatesWalkers = None,
         **kwargs,
     ) -> StatesModel:
-        def random_choice_prob_index(a, axis=1):
-            """Select random actions with probabilities across a batch.
-            
-            Source: https://stackoverflow.com/a/47722393/287335"""
-            r = np.expand_dims(self.random_state.rand(a.shape[1 - axis]), axis=axis)
-            return (a.cumsum(axis=axis) > r).argmax(axis=axis)
-
         if env_states is not None:
             # Each state is a vstack([node_ids, mask]) and we only want the mask.
             #
             # Swap columns and slice the last element to get it.
             masks = env_states.observs[:, -self.n_actions :]
-            actions = random_choice_prob_index(masks)
+            actions = random_choice_prob_index(self.random_state, masks)
         else:
             actions = self.random_state.randint(0, self.n_actions, size=batch_size)
         return self.update_states_with_critic(
@@ -91,6 +121,11 @@ class FragileMathyEnv(DiscreteEnv):
     def __getattr__(self, item):
         return getattr(self._env, item)
 
+    def get_params_dict(self) -> StateDict:
+        params = super(FragileMathyEnv, self).get_params_dict()
+        params["states"]["dtype"] = STATE_DTYPE
+        return params
+
     def make_transitions(
         self, states: np.ndarray, actions: np.ndarray, dt: Union[np.ndarray, int]
     ) -> Dict[str, np.ndarray]:
@@ -103,15 +138,31 @@ class FragileMathyEnv(DiscreteEnv):
         )
         terminals = [inf.get("done", False) for inf in infos]
         data = {
-            "states": np.array(new_states),
-            "observs": np.array(observs),
-            "rewards": np.array(rewards),
-            "oobs": np.array(oobs),
+            "states": new_states,
+            "observs": observs,
+            "rewards": rewards,
+            "oobs": oobs,
             "terminals": np.array(terminals),
         }
         return data
 
 
+def state_to_np(state: MathyEnvState) -> np.ndarray:
+    """Encode an env state into the fixed-size array stored by the swarm."""
+    return state.to_np(STATE_PAD_SIZE).astype(STATE_DTYPE)
+
+
+@lru_cache(maxsize=2048)
+def state_from_bytes(state_bytes: bytes) -> MathyEnvState:
+    """Decode an encoded env state, memoized because walkers that were cloned
+    from each other share identical states. Callers should strip the padding
+    from the state before converting it to bytes to keep cache keys small, and
+    clear the cache between problems.
+
+    NOTE: the returned state is shared between callers and must not be mutated."""
+    return MathyEnvState.from_np(np.frombuffer(state_bytes, dtype=STATE_DTYPE))
+
+
 class FragileEnvironment:
     """Fragile Environment for solving Mathy problems."""
 
@@ -143,15 +194,22 @@ class FragileEnvironment:
         self.action_space = spaces.Discrete(self._env.action_size)
         self.problem = problem
         self.max_steps = max_steps
-        self._env.reset()
+        # Observations have a fixed size per env, so remember it for batching
+        observation = np.asarray(self._env.reset())
+        self._observs_shape = observation.shape
+        self._observs_dtype = observation.dtype
 
     def get_state(self) -> np.ndarray:
         assert self._env.state is not None, "env required to get_state"
-        return self._env.state.to_np(2048)
+        return state_to_np(self._env.state)
 
     def set_state(self, state: np.ndarray):
         assert self._env is not None, "env required to set_state"
-        self._env.state = MathyEnvState.from_np(state)
+        assert state.dtype == STATE_DTYPE, f"expected {STATE_DTYPE} state array"
+        # Key the decode cache on the state without its trailing padding
+        content = np.flatnonzero(state != STATE_PAD_VALUE)
+        size = content[-1] + 1 if content.size > 0 else 0
+        self._env.state = state_from_bytes(state[:size].tobytes())
         return state
 
     def step(self, action: int, state: np.ndarray = None) -> tuple:
@@ -164,18 +222,29 @@ class FragileEnvironment:
         return new_state, obs, reward, oob, info
 
     def step_batch(
-        self, actions, states:Optional[Any]=None, n_repeat_action: Optional[Union[int, np.ndarray]] = None
+        self,
+        actions,
+        states: Optional[Any] = None,
+        n_repeat_action: Optional[Union[int, np.ndarray]] = None,
     ) -> tuple:
-        data = [self.step(action, state) for action, state in zip(actions, states)]
-        new_states, observs, rewards, terminals, infos = [], [], [], [], []
-        for d in data:
-            new_state, obs, _reward, end, info = d
-            new_states.append(new_state)
-            observs.append(obs)
-            rewards.append(_reward)
-            terminals.append(end)
+        batch_size = len(actions)
+        # Write each step's outputs directly into batch arrays rather than
+        # building per-walker lists that get copied into arrays afterward.
+        new_states = np.empty((batch_size, STATE_PAD_SIZE), dtype=STATE_DTYPE)
+        observs = np.empty(
+            (batch_size,) + self._observs_shape, dtype=self._observs_dtype
+        )
+        rewards = np.empty(batch_size, dtype=np.float32)
+        oobs = np.empty(batch_size, dtype=np.bool_)
+        infos = []
+        for i, (action, state) in enumerate(zip(actions, states)):
+            new_state, obs, reward, oob, info = self.step(action, state)
+            new_states[i] = new_state
+            observs[i] = obs
+            rewards[i] = reward
+            oobs[i] = oob
             infos.append(info)
-        return new_states, observs, rewards, terminals, infos
+        return new_states, observs, rewards, oobs, infos
 
     def reset(self, batch_size: int = 1):
         assert self._env is not None, "env required to reset"
@@ -188,14 +257,22 @@ def mathy_swarm(config: SwarmConfig, env_callable=None) -> Swarm:
         env_callable = lambda: FragileMathyEnv(
             name="mathy_v0", repeat_problem=config.single_problem
         )
+    swarm_env_callable = env_callable
     if config.use_mp:
-        env_callable = ParallelEnv(env_callable=env_callable)
+        # Swarm calls env() on what it's given, and calling a ParallelEnv instance
+        # unwraps it to its local env, which steps every walker in this process.
+        # Pass a callable that builds the ParallelEnv so the workers are used.
+        swarm_env_callable = lambda: ParallelEnv(
+            # More workers than walkers would leave some with nothing to step
+            env_callable=env_callable,
+            n_workers=min(config.n_workers, config.n_walkers),
+        )
     tree_callable = None
     if config.history:
         tree_callable = lambda: HistoryTree(prune=True, names=config.history_names)
     swarm = Swarm(
         model=lambda env: DiscreteMasked(env=env),
-        env=env_callable,
+        env=swarm_env_callable,
         tree=tree_callable,
         reward_limit=EnvRewards.WIN,
         n_walkers=config.n_walkers,
@@ -222,8 +299,9 @@ def swarm_solve(
     assert len(problems) > 0, "no problems to solve"
     assert len(problems) == len(max_steps)
     assert isinstance(problems, list)
-    current_problem: str = problems.pop(0)
-    current_max_moves: int = max_steps.pop(0)
+    # Iterate over pairs instead of popping from (and mutating) the caller's lists
+    work = list(zip(problems, max_steps))
+    current_problem, current_max_moves = work[0]
 
     def env_callable():
         nonlocal current_problem, current_max_moves
@@ -234,9 +312,13 @@ def swarm_solve(
             max_steps=current_max_moves,
         )
 
-    mathy_env: MathyEnv = env_callable()._env._env.mathy
+    # Clear before building the swarm so forked env workers start out empty
+    state_from_bytes.cache_clear()
     swarm: Swarm = mathy_swarm(config, env_callable)
-    while True:
+    # Reuse the swarm's own env rather than building a throwaway one
+    mathy_env: MathyEnv = swarm.env._env._env.mathy
+    for current_problem, current_max_moves in work:
+        state_from_bytes.cache_clear()
         if not silent:
             with msg.loading(f"Solving {current_problem} ..."):
                 swarm.run()
@@ -250,10 +332,4 @@ def swarm_solve(
                 mathy_env.print_history(last_state)
             else:
                 msg.fail(f"Failed to find a solution :(")
-
-        if len(max_steps) > 0:
-            current_max_moves = max_steps.pop(0)
-            current_problem = problems.pop(0)
-        else:
-            break
     return swarm
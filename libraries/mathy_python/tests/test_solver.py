@@ -0,0 +1,86 @@
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from fragile.distributed.env import ParallelEnv
+from mathy.solver import (
+    FragileEnvironment,
+    SwarmConfig,
+    mathy_swarm,
+    random_choice_prob_index,
+    state_from_bytes,
+    state_to_np,
+)
+from mathy_core import ExpressionParser
+from mathy_envs import MathyEnvState
+
+
+def test_solver_random_choice_prob_index():
+    random_state = np.random.RandomState(1337)
+    # Each row only has one valid action, so it must always be chosen
+    masks = np.eye(4)[[2, 0, 3, 1]]
+    actions = random_choice_prob_index(random_state, masks)
+    assert actions.tolist() == [2, 0, 3, 1]
+
+
+def test_solver_state_from_bytes():
+    state = MathyEnvState(problem="4x + 2x", max_moves=12)
+    state_bytes = state_to_np(state).tobytes()
+    state_from_bytes.cache_clear()
+    decoded = state_from_bytes(state_bytes)
+    assert decoded.agent.problem == "4x + 2x"
+    assert decoded.max_moves == 12
+    # Repeated decodes of the same bytes are served from the cache
+    assert state_from_bytes(state_bytes) is decoded
+
+
+def test_solver_state_encoding_non_ascii():
+    # The tokenizer accepts "–" (U+2013) as a minus sign
+    problem = "4x – 2x"
+    state = MathyEnvState(problem=problem, max_moves=12)
+    decoded = state_from_bytes(state_to_np(state).tobytes())
+    assert decoded.agent.problem == problem
+    assert decoded.agent.history[0].raw == problem
+    ExpressionParser().parse(decoded.agent.problem)
+
+
+def test_solver_mathy_swarm_parallel_env():
+    swarm = mathy_swarm(SwarmConfig(n_walkers=2, n_workers=8, max_iters=2))
+    try:
+        # The swarm steps through the ParallelEnv rather than its local env
+        assert isinstance(swarm.env, ParallelEnv)
+        # Workers are capped at the number of walkers
+        assert swarm.env.n_workers == 2
+        assert len(swarm.env.parallel_env._batch_env) == 2
+        parallel_env = swarm.env.parallel_env
+        with patch.object(
+            parallel_env, "make_transitions", wraps=parallel_env.make_transitions
+        ) as mock:
+            swarm.run()
+        assert mock.called
+    finally:
+        swarm.env.close()
+
+
+def test_solver_step_batch_empty():
+    env = FragileEnvironment(name="mathy_v0", problem="4x + 2x")
+    new_states, observs, rewards, oobs, infos = env.step_batch(actions=[], states=[])
+    assert new_states.shape == (0,) + env.get_state().shape
+    assert observs.shape[0] == rewards.shape[0] == oobs.shape[0] == len(infos) == 0
+
+
+def test_solver_swarm_config_n_workers():
+    with pytest.raises(ValueError):
+        SwarmConfig(n_workers=0)
+
+
+def test_solver_set_state_strips_padding():
+    env = FragileEnvironment(name="mathy_v0", problem="4x + 2x")
+    state = env.get_state()
+    state_from_bytes.cache_clear()
+    env.set_state(state)
+    assert env._env.state.agent.problem == "4x + 2x"
+    # The cache key is the state text only, not the whole padded buffer
+    text_size = len(env._env.state.to_string())
+    assert state_from_bytes(state[:text_size].tobytes()) is env._env.state
+    assert state_from_bytes.cache_info().currsize == 1